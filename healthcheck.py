@@ -1,15 +1,12 @@
+import asyncio
 import logging
 import os
-import random
-import secrets
 import signal
 import socket
 import struct
 import time
 from dataclasses import dataclass
-from io import BytesIO
-from threading import Event, Thread
-from typing import Callable, Self
+from typing import Self
 
 import prometheus_client
 
@@ -21,6 +18,26 @@ logger.setLevel(logging.INFO)
 # Don't ask me where it's from...
 MAGIC = bytes.fromhex("00ffff00fefefefefdfdfdfd12345678")
 
+# Little-endian timestamp written into each unconnected ping.
+# It's taken from the monotonic clock in milliseconds, because pongs are matched on it:
+# a wall clock step could make it negative or repeat an earlier ping's value.
+_TS_STRUCT = struct.Struct("<Q")
+
+# `SOCK_NONBLOCK` saves a separate `setblocking` call, but it only exists on Linux.
+_SOCK_NONBLOCK = getattr(socket, "SOCK_NONBLOCK", 0)
+
+# Client GUID sent with every ping. RakNet expects this to stay the same for a client,
+# and pongs are matched on the echoed ping time, so it is only generated once.
+_CLIENT_GUID = os.urandom(8)
+
+# Replies are received into this buffer rather than allocating one per healthcheck.
+# Only the fixed-size header of a pong is inspected, so the MOTD can be truncated.
+_PONG_BUFFER = bytearray(64)
+
+# Unconnected pong: ID (1), echoed ping time (8), server GUID (8), MAGIC (16),
+# MOTD length (2), MOTD.
+_PONG_MIN_SIZE = 35
+
 
 @dataclass
 class Environ:
@@ -41,136 +58,190 @@ class Environ:
 
 class HealthcheckResult:
     def __init__(self, prefix: str) -> None:
-        self.attempt_counter = prometheus_client.Counter(
-            f"{prefix}:attempt", "Number of attempted healthchecks."
+        self.probe_histogram = prometheus_client.Histogram(
+            f"{prefix}_probe_seconds",
+            "Duration of attempted healthchecks, including failed ones.",
+            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, float("inf")),
+        )
+        self.error_counter = prometheus_client.Counter(
+            f"{prefix}_errors", "Number of failed healthchecks."
         )
         self.healthy_gauge = prometheus_client.Gauge(
-            f"{prefix}:healthy",
+            f"{prefix}_healthy",
             "1 if the server is healthy. 0 if the server is unhealthy or not checked.",
         )
-        self.unhealthy_gauge = prometheus_client.Gauge(
-            f"{prefix}:unhealthy",
-            "1 if the server is unhealthy. 0 if the server is unhealthy or not checked.",
-        )
+        self._last_healthy: bool | None = None
 
-    def mark_attempt(self) -> None:
-        self.attempt_counter.inc()
+    def observe_attempt(self, seconds: float) -> None:
+        self.probe_histogram.observe(seconds)
 
     def mark_healthy(self) -> None:
-        self.healthy_gauge.set(1)
-        self.unhealthy_gauge.set(0)
+        self._set_healthy(True)
 
     def mark_unhealthy(self) -> None:
-        self.healthy_gauge.set(0)
-        self.unhealthy_gauge.set(1)
-
+        self.error_counter.inc()
+        self._set_healthy(False)
 
-def build_ping_packet() -> bytes:
-    buf = BytesIO()
-    buf.write(b"\x01")
-    buf.write(int(time.time()).to_bytes(8, "big"))
-    buf.write(MAGIC)
-    buf.write(random.randbytes(8))
-    return buf.getvalue()
+    def _set_healthy(self, healthy: bool) -> None:
+        if self._last_healthy is healthy:
+            return
+        self.healthy_gauge.set(1 if healthy else 0)
+        self._last_healthy = healthy
 
 
 def create_unconnected_ping_frame(start_time: int):
     packet = bytearray(33)
     packet[0] = 0x01
-    struct.pack_into("<Q", packet, 1, int((time.time() * 1000) - start_time))
+    _TS_STRUCT.pack_into(packet, 1, time.monotonic_ns() // 1_000_000 - start_time)
     packet[9:25] = MAGIC
-    packet[25:33] = secrets.token_bytes(8)
+    packet[25:33] = _CLIENT_GUID
     return bytes(packet)
 
 
-def ping_bedrock(environ: Environ, start_time: int, timeout: float = 1.0) -> bool:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.settimeout(timeout)
+async def resolve_minecraft_addr(environ: Environ) -> tuple[str, int]:
+    # Resolve off the event loop thread,
+    # so a slow resolver can't stall shutdown or probe timeouts.
+    loop = asyncio.get_running_loop()
+    addrinfo = await loop.getaddrinfo(
+        environ.minecraft_host,
+        environ.minecraft_port,
+        family=socket.AF_INET,
+        type=socket.SOCK_DGRAM,
+    )
+    return addrinfo[0][4]
 
-    try:
-        ping_packet = create_unconnected_ping_frame(start_time)
-        sock.sendto(ping_packet, (environ.minecraft_host, environ.minecraft_port))
 
-        pong_packet, _ = sock.recvfrom(1024)
-        if pong_packet[0] == 0x1C:
-            return True
-        return False
-    finally:
+async def open_bedrock_socket(environ: Environ) -> socket.socket:
+    # The address is only resolved when a socket is opened,
+    # so a failed healthcheck (which drops the socket) also re-resolves it.
+    addr = await resolve_minecraft_addr(environ)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM | _SOCK_NONBLOCK)
+    try:
+        if not _SOCK_NONBLOCK:
+            sock.setblocking(False)
+        # Connecting a UDP socket makes the kernel drop datagrams from other peers.
+        sock.connect(addr)
+    except OSError:
         sock.close()
+        raise
+    return sock
+
+
+def is_matching_pong(ping_packet: bytes, pong_packet: bytearray, size: int) -> bool:
+    return (
+        size >= _PONG_MIN_SIZE
+        and pong_packet[0] == 0x1C
+        and pong_packet[1:9] == ping_packet[1:9]
+        and pong_packet[17:33] == MAGIC
+    )
 
 
-def healthcheck_minecraft_server(environ: Environ, healthcheck_result: HealthcheckResult, start_time: int) -> None:
-    logger.info(
-        f"Attempting healthcheck {environ.minecraft_host}:{environ.minecraft_port}"
+async def ping_bedrock(start_time: int, sock: socket.socket) -> None:
+    loop = asyncio.get_running_loop()
+    ping_packet = create_unconnected_ping_frame(start_time)
+    await loop.sock_sendall(sock, ping_packet)
+
+    # Skip over late pongs from earlier healthchecks,
+    # or anything else that isn't a reply to this ping.
+    while True:
+        size = await loop.sock_recv_into(sock, _PONG_BUFFER)
+        if is_matching_pong(ping_packet, _PONG_BUFFER, size):
+            return
+
+
+async def healthcheck_minecraft_server(
+    environ: Environ,
+    healthcheck_result: HealthcheckResult,
+    start_time: int,
+    sock: socket.socket | None,
+    timeout: float = 1.0,
+) -> socket.socket | None:
+    logger.debug(
+        "Attempting healthcheck %s:%s", environ.minecraft_host, environ.minecraft_port
     )
-    healthcheck_result.mark_attempt()
+    attempt_start = time.perf_counter()
     try:
-        healthy = ping_bedrock(environ, start_time)
-        logger.info("Healthcheck succeeded")
+        # Resolving the host counts against the timeout too,
+        # so a hung resolver fails the healthcheck instead of stalling it.
+        async with asyncio.timeout(timeout):
+            if sock is None or sock.fileno() == -1:
+                sock = await open_bedrock_socket(environ)
+            await ping_bedrock(start_time, sock)
+        logger.debug("Healthcheck succeeded")
         healthcheck_result.mark_healthy()
     except Exception:
         logger.error("Healthcheck failed", exc_info=True)
         healthcheck_result.mark_unhealthy()
+        # Drop the socket so that the next healthcheck starts from a clean one.
+        if sock is not None:
+            sock.close()
+    except BaseException:
+        # The caller never sees a socket opened by this healthcheck if it's cancelled,
+        # so close it here rather than leaking it.
+        if sock is not None:
+            sock.close()
+        raise
+    healthcheck_result.observe_attempt(time.perf_counter() - attempt_start)
+    return sock
+
+
+async def ping_minecraft_server_main(environ: Environ, interval: float = 1.0) -> None:
+    loop = asyncio.get_running_loop()
+    healthcheck_result = HealthcheckResult("minecraft_healthcheck")
+    start_time = time.monotonic_ns() // 1_000_000
+    sock: socket.socket | None = None
+    next_probe = loop.time()
+    try:
+        while True:
+            await asyncio.sleep(max(0.0, next_probe - loop.time()))
+            try:
+                sock = await healthcheck_minecraft_server(
+                    environ, healthcheck_result, start_time, sock
+                )
+            except Exception:
+                logger.error("Encountered unexpected error", exc_info=True)
+
+            # Don't try to catch up on probes missed while a healthcheck was stalled.
+            next_probe = max(next_probe + interval, loop.time())
+    finally:
+        if sock is not None:
+            sock.close()
 
 
-def ping_minecraft_server_main(environ: Environ, shutdown: Event) -> None:
-    healthcheck_result = HealthcheckResult("minecraft:healthcheck")
-    start_time = int(time.time() * 1000)
-    time_since_last_ping = 0.0
-    last_time = time.monotonic()
-    while not shutdown.is_set():
-        try:
-            now = time.monotonic()
-            time_since_last_ping -= now - last_time
-            last_time = now
-
-            if time_since_last_ping <= 0.0:
-                time_since_last_ping = 1.0
-                healthcheck_minecraft_server(environ, healthcheck_result, start_time)
-
-            time.sleep(0.1)
-        except Exception:
-            logger.error("Encountered unexpected error", exc_info=True)
-
-
-def signal_handler(shutdown: Event) -> Callable[..., None]:
-    def _signal_handler(*args, **kwargs):
-        if shutdown.is_set():
-            exit(1)
-
-        logger.info("Shutting down...")
-        shutdown.set()
-
-    return _signal_handler
+SHUTDOWN_SIGNALS = (signal.SIGINT, signal.SIGTERM)
 
 
-def main() -> None:
+async def amain() -> None:
     environ = Environ.from_env()
-    shutdown = Event()
-
-    handler = signal_handler(shutdown)
-    signal.signal(signal.SIGINT, handler)
-    signal.signal(signal.SIGTERM, handler)
+    loop = asyncio.get_running_loop()
 
     server, server_thread = prometheus_client.start_http_server(
         addr=environ.prometheus_host,
         port=environ.prometheus_port,
     )
 
-    healthcheck_thread = Thread(
-        target=ping_minecraft_server_main,
-        args=[environ, shutdown],
-    )
-    healthcheck_thread.start()
+    healthcheck_task = asyncio.create_task(ping_minecraft_server_main(environ))
+    for sig in SHUTDOWN_SIGNALS:
+        loop.add_signal_handler(sig, healthcheck_task.cancel)
 
-    shutdown.wait()
+    try:
+        await healthcheck_task
+    except asyncio.CancelledError:
+        pass
+    logger.info("Shutting down...")
+
+    # Let a second signal fall through to its default behavior,
+    # so that a stuck shutdown can still be interrupted.
+    for sig in SHUTDOWN_SIGNALS:
+        loop.remove_signal_handler(sig)
 
     logger.info("Shutting down prometheus server...")
     server.shutdown()
     server_thread.join()
 
-    logger.info("Shutting down healthcheck thread...")
-    healthcheck_thread.join()
+
+def main() -> None:
+    asyncio.run(amain())
 
 
 if __name__ == "__main__":
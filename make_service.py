@@ -1,6 +1,9 @@
+import os
 from pathlib import Path
 
-TEMPLATE = """\
+
+def render_service(directory: Path) -> str:
+    return f"""\
 [Unit]
 Description=Minecraft Server Healthcheck
 After=network-online.target
@@ -9,7 +12,7 @@ After=network-online.target
 User=minecraft
 Group=minecraft
 Restart=on-failure
-ExecStart=uv {directory}/healthcheck.py
+ExecStart=uv run {directory}/healthcheck.py
 WorkingDirectory={directory}
 Environment="PYTHONPATH={directory}"
 
@@ -20,7 +23,12 @@ WantedBy=multi-user.target
 
 def main() -> None:
     cwd = Path.cwd()
-    (cwd / "minecraft_healthcheck.service").write_text(TEMPLATE.format(directory=cwd))
+    target = cwd / "minecraft_healthcheck.service"
+    # Write to a temporary file and rename it into place,
+    # so a partial write never leaves a truncated unit file behind.
+    tmp = target.with_suffix(".service.tmp")
+    tmp.write_text(render_service(cwd), encoding="utf-8")
+    os.replace(tmp, target)
 
 
 if __name__ == "__main__":